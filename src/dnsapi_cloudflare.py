@@ -37,6 +37,28 @@ import datetime
 import logging
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Session shared by all calls so repeated requests to the API endpoint reuse
+# one pooled TCP+TLS connection instead of paying a fresh handshake per record.
+_session = requests.Session()
+# Transient failures (rate limiting, gateway errors) back off and retry at
+# the adapter level instead of failing the domain and forcing a rerun.
+_adapter = HTTPAdapter( pool_connections = 4, pool_maxsize = 16,
+                        max_retries = Retry( total = 5, connect = 3, read = 3, status = 3,
+                                             backoff_factor = 0.5,
+                                             status_forcelist = (429, 500, 502, 503, 504),
+                                             allowed_methods = frozenset( ['GET', 'POST'] ),
+                                             raise_on_status = False,
+                                             respect_retry_after_header = True ) )
+_session.mount( 'http://', _adapter )
+_session.mount( 'https://', _adapter )
+
+
+def close():
+    # Called by genkeys.py after the DNS update loop is done with the module
+    _session.close()
 
 
 def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
@@ -80,7 +102,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         'content': data,
         'ttl': ttl
     }
-    resp = requests.post( endpoint, json = body, headers = hdr )
+    resp = _session.post( endpoint, json = body, headers = hdr, timeout = (5, 30) )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
@@ -88,7 +110,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         if success:
             data = resp.json()['result']
             if data:
-                result = True, key_data['domain'], selector, datetime.datetime.utcnow(), data['id']
+                result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc ), data['id']
             else:
                 logging.error( "DNS API cloudflare: could not find result data in response" )
                 result = False,
@@ -103,6 +125,82 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     return result
 
 
+def add_batch( dnsapi_data, batch_items, debugging = False ):
+    # Sends all new records in one transaction per zone through the batch
+    # endpoint (POST .../dns_records/batch with a 'posts' array), so N records
+    # cost one HTTP round-trip per zone instead of N. batch_items is a list of
+    # (dnsapi_domain_data, key_data) pairs; returns one add()-style result
+    # tuple per item, in order.
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API cloudflare: API credentials not configured" )
+        return [(False,)] * len( batch_items )
+    api_key = dnsapi_data[0]
+    email = dnsapi_data[1]
+    hdr = {
+        'Content-Type': 'application/json',
+        'X-Auth-Key': api_key,
+        'X-Auth-Email': email
+    }
+
+    results = [(False,)] * len( batch_items )
+    zones = { }  # Key = zone ID, Value = list of (item index, record body)
+    for index, (dnsapi_domain_data, key_data) in enumerate( batch_items ):
+        if len( dnsapi_domain_data ) < 1:
+            logging.error( "DNS API cloudflare: domain data does not contain zone ID" )
+            continue
+        zone_id = dnsapi_domain_data[0]
+        if len( dnsapi_domain_data ) > 1:
+            try:
+                ttl = int( dnsapi_domain_data[1] )
+                if ttl < 1:
+                    ttl = 1
+            except Exception:
+                ttl = 1
+        else:
+            ttl = 1
+        try:
+            selector = key_data['selector']
+            data = key_data['plain']
+            domain_suffix = key_data['domain']
+        except KeyError as e:
+            logging.error( "DNS API cloudflare: required information not present: %s", str( e ) )
+            continue
+        if debugging:
+            results[index] = True, key_data['domain'], selector
+            continue
+        zones.setdefault( zone_id, [] ).append(
+            (index, {
+                'type': 'TXT',
+                'name': selector + '._domainkey.' + domain_suffix,
+                'content': data,
+                'ttl': ttl
+            }) )
+
+    for zone_id, entries in zones.items():
+        endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records/batch".format( zone_id )
+        body = { 'posts': [record for index, record in entries] }
+        resp = _session.post( endpoint, json = body, headers = hdr, timeout = (5, 30) )
+        logging.info( "HTTP status: %d", resp.status_code )
+
+        if resp.status_code == requests.codes.ok:
+            if resp.json()['success']:
+                posts = resp.json()['result'].get( 'posts', [] )
+                if len( posts ) != len( entries ):
+                    logging.error( "DNS API cloudflare: could not find result data in response" )
+                created = datetime.datetime.now( datetime.timezone.utc )
+                for (index, record), data in zip( entries, posts ):
+                    key_data = batch_items[index][1]
+                    results[index] = True, key_data['domain'], key_data['selector'], created, \
+                                     data['id']
+            else:
+                logging.error( "DNS API cloudflare: failure:\n%s", resp.text )
+        else:
+            logging.error( "DNS API cloudflare: HTTP error %d", resp.status_code )
+            logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+
+    return results
+
+
 def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
     # TODO delete record
     return None
@@ -87,7 +87,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         response = cf.zones.dns_records.post( zone_id, data = request_params )
         if response:
             # TODO need resource ID appended to result
-            result = True, key_data['domain'], selector, datetime.datetime.utcnow()
+            result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc )
         else:
             result = False,
     except CloudFlare.exceptions.CloudFlareAPIError as e:
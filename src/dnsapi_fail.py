@@ -43,7 +43,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     if len( dnsapi_data ) == 0 or 'add' in dnsapi_data:
         return False,
     else:
-        return True, key_data['domain'], key_data['selector'], datetime.datetime.utcnow(), '-'
+        return True, key_data['domain'], key_data['selector'], datetime.datetime.now( datetime.timezone.utc ), '-'
 
 
 def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
@@ -50,6 +50,28 @@ import re
 
 import requests
 import w3lib.html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Session shared by all calls so repeated requests to the API endpoint reuse
+# one pooled TCP+TLS connection instead of paying a fresh handshake per record.
+_session = requests.Session()
+# Transient failures (rate limiting, gateway errors) back off and retry at
+# the adapter level instead of failing the domain and forcing a rerun.
+_adapter = HTTPAdapter( pool_connections = 4, pool_maxsize = 16,
+                        max_retries = Retry( total = 5, connect = 3, read = 3, status = 3,
+                                             backoff_factor = 0.5,
+                                             status_forcelist = (429, 500, 502, 503, 504),
+                                             allowed_methods = frozenset( ['GET', 'POST'] ),
+                                             raise_on_status = False,
+                                             respect_retry_after_header = True ) )
+_session.mount( 'http://', _adapter )
+_session.mount( 'https://', _adapter )
+
+
+def close():
+    # Called by genkeys.py after the DNS update loop is done with the module
+    _session.close()
 
 
 def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
@@ -70,7 +92,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     if debugging:
         return True, key_data['domain'], selector
 
-    resp = requests.post( 'https://freedns.afraid.org/subdomain/save.php?step=2',
+    resp = _session.post( 'https://freedns.afraid.org/subdomain/save.php?step=2',
                           data = {
                               'type': 'TXT',
                               'subdomain': selector + '._domainkey',
@@ -79,7 +101,8 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
                               'ttl': '',
                               'send': 'Save!'
                           },
-                          cookies = { 'dns_cookie': cookie_value } )
+                          cookies = { 'dns_cookie': cookie_value },
+                          timeout = (5, 30) )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
@@ -94,7 +117,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
             logging.error( "DNS API freedns: could not locate record ID in subdomains page" )
             result = False,
         else:
-            result = True, key_data['domain'], selector, datetime.datetime.utcnow(), record_id
+            result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc ), record_id
     else:
         result = False,
         logging.error( "DNS API freedns: HTTP error %d", resp.status_code )
@@ -118,9 +141,10 @@ def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
     if debugging:
         return True
 
-    resp = requests.get( 'https://freedns.afraid.org/subdomain/delete2.php',
-                         { 'data_id[]': record_id, 'submit': 'delete selected' },
-                         cookies = { 'dns_cookie': cookie_value } )
+    resp = _session.get( 'https://freedns.afraid.org/subdomain/delete2.php',
+                         params = { 'data_id[]': record_id, 'submit': 'delete selected' },
+                         cookies = { 'dns_cookie': cookie_value },
+                         timeout = (5, 30) )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
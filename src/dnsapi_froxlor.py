@@ -16,7 +16,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# Uses the 'requests' package.
+# Uses the 'requests' package, or 'httpx' with the 'h2' extra if installed
+# (enables HTTP/2, so concurrent updates multiplex over one TLS connection).
 
 # Requires:
 # dnsapi_data[0]        : API Endpoint
@@ -37,6 +38,62 @@ import datetime
 import logging
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Prefer an HTTP/2-capable httpx client when the optional dependency is
+# available: the driver's worker threads then multiplex their calls as
+# streams inside one TLS connection instead of holding one connection each.
+# Otherwise fall back to a requests session shared by all calls, which still
+# reuses one pooled TCP+TLS connection instead of paying a fresh handshake
+# per record.
+try:
+    import httpx
+    # httpx only imports h2 lazily once ALPN negotiates HTTP/2, so probe for
+    # the extra here; without it the client would raise mid-request instead
+    # of falling back to the requests session.
+    import h2
+    _client = httpx.Client( transport = httpx.HTTPTransport(
+                                http2 = True, retries = 3,
+                                limits = httpx.Limits( max_keepalive_connections = 4,
+                                                       max_connections = 8 ) ),
+                            timeout = 30.0,
+                            headers = { 'Content-Type': 'application/json' } )
+except ImportError:
+    _client = None
+    _session = requests.Session()
+    _session.headers.update( { 'Content-Type': 'application/json' } )
+    # Transient failures (rate limiting, gateway errors) back off and retry at
+    # the adapter level instead of failing the domain and forcing a rerun.
+    _adapter = HTTPAdapter( pool_connections = 4, pool_maxsize = 16,
+                            max_retries = Retry( total = 5, connect = 3, read = 3, status = 3,
+                                                 backoff_factor = 0.5,
+                                                 status_forcelist = (429, 500, 502, 503, 504),
+                                                 allowed_methods = frozenset( ['GET', 'POST'] ),
+                                                 raise_on_status = False,
+                                                 respect_retry_after_header = True ) )
+    _session.mount( 'http://', _adapter )
+    _session.mount( 'https://', _adapter )
+
+
+def _post( url, body, auth ):
+    if _client is not None:
+        # Normalize transport failures to the requests exception hierarchy so
+        # the driver's worker guards fail just this domain, whichever client
+        # is active.
+        try:
+            return _client.post( url, json = body, auth = auth )
+        except httpx.HTTPError as e:
+            raise requests.RequestException( str( e ) ) from e
+    return _session.post( url, json = body, auth = auth, timeout = (5, 30) )
+
+
+def close():
+    # Called by genkeys.py after the DNS update loop is done with the module
+    if _client is not None:
+        _client.close()
+    else:
+        _session.close()
 
 
 def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
@@ -68,9 +125,6 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     if debugging:
         return True, key_data['domain'], selector
 
-    hdr = {
-        'Content-Type': 'application/json'
-    }
     body = {
         'command': 'DomainZones.add',
         'params': {
@@ -81,11 +135,11 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
             'ttl': ttl
         }
     }
-    resp = requests.post( api_endpoint, json = body, headers = hdr, auth=(api_key, api_secret) )
+    resp = _post( api_endpoint, body, (api_key, api_secret) )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
-        result = True, key_data['domain'], selector, datetime.datetime.utcnow()
+        result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc )
     else:
         result = False,
         logging.error( "DNS API froxlor: HTTP error %d", resp.status_code )
@@ -94,6 +148,13 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     return result
 
 
+def add_batch( dnsapi_data, batch_items, debugging = False ):
+    # Froxlor has no multi-record call, but looping here sends every add
+    # back-to-back over the module's pooled keep-alive connection.
+    return [add( dnsapi_data, dnsapi_domain_data, key_data, debugging )
+            for dnsapi_domain_data, key_data in batch_items]
+
+
 def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
     # TODO delete record
     return None
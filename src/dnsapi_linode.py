@@ -37,6 +37,28 @@ import datetime
 import logging
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Session shared by all calls so repeated requests to the API endpoint reuse
+# one pooled TCP+TLS connection instead of paying a fresh handshake per record.
+_session = requests.Session()
+# Transient failures (rate limiting, gateway errors) back off and retry at
+# the adapter level instead of failing the domain and forcing a rerun.
+_adapter = HTTPAdapter( pool_connections = 4, pool_maxsize = 16,
+                        max_retries = Retry( total = 5, connect = 3, read = 3, status = 3,
+                                             backoff_factor = 0.5,
+                                             status_forcelist = (429, 500, 502, 503, 504),
+                                             allowed_methods = frozenset( ['GET', 'POST'] ),
+                                             raise_on_status = False,
+                                             respect_retry_after_header = True ) )
+_session.mount( 'http://', _adapter )
+_session.mount( 'https://', _adapter )
+
+
+def close():
+    # Called by genkeys.py after the DNS update loop is done with the module
+    _session.close()
 
 
 def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
@@ -57,7 +79,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     if debugging:
         return True,
 
-    resp = requests.post( "https://api.linode.com/",
+    resp = _session.post( "https://api.linode.com/",
                           data = {
                               'api_key': api_key,
                               'api_action': 'domain.resource.create',
@@ -65,7 +87,8 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
                               'Type': 'TXT',
                               'Name': selector + "._domainkey",
                               'Target': data
-                          } )
+                          },
+                          timeout = (5, 30) )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
@@ -77,7 +100,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         else:
             data = resp.json()['DATA']
             if data:
-                result = True, key_data['domain'], selector, datetime.datetime.utcnow(), data['ResourceID']
+                result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc ), data['ResourceID']
             else:
                 logging.error( "DNS API linode: could not locate data in response" )
                 result = False,
@@ -106,12 +129,13 @@ def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
     if debugging:
         return True
 
-    resp = requests.post("https://api.linode.com/",
+    resp = _session.post("https://api.linode.com/",
                          data = {'api_key':    api_key,
                                  'api_action': 'domain.resource.delete',
                                  'DomainID':   domain_id,
                                  'ResourceID': resource_id,
-                         })
+                         },
+                         timeout = (5, 30))
     logging.info("HTTP status: %d", resp.status_code)
 
     if resp.status_code == requests.codes.ok:
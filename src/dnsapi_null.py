@@ -36,7 +36,7 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         logging.debug( "    key data   :" )
         for key, value in key_data.iteritems():
             logging.debug( '        %s: %s', key, value )
-    return True, key_data['domain'], key_data['selector'], datetime.datetime.utcnow(), '-'
+    return True, key_data['domain'], key_data['selector'], datetime.datetime.now( datetime.timezone.utc ), '-'
 
 
 def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
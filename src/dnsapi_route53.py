@@ -41,7 +41,29 @@ import logging
 import xml.dom.minidom
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_aws4auth import AWS4Auth
+from urllib3.util.retry import Retry
+
+# Session shared by all calls so repeated requests to the API endpoint reuse
+# one pooled TCP+TLS connection instead of paying a fresh handshake per record.
+_session = requests.Session()
+# Transient failures (rate limiting, gateway errors) back off and retry at
+# the adapter level instead of failing the domain and forcing a rerun.
+_adapter = HTTPAdapter( pool_connections = 4, pool_maxsize = 16,
+                        max_retries = Retry( total = 5, connect = 3, read = 3, status = 3,
+                                             backoff_factor = 0.5,
+                                             status_forcelist = (429, 500, 502, 503, 504),
+                                             allowed_methods = frozenset( ['GET', 'POST'] ),
+                                             raise_on_status = False,
+                                             respect_retry_after_header = True ) )
+_session.mount( 'http://', _adapter )
+_session.mount( 'https://', _adapter )
+
+
+def close():
+    # Called by genkeys.py after the DNS update loop is done with the module
+    _session.close()
 
 
 def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
@@ -81,14 +103,15 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
 
     endpoint = "https://route53.amazonaws.com/2013-04-01/hostedzone/{0}/rrset".format(zone_id)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    resp = requests.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers)
+    resp = _session.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers,
+                         timeout = (5, 30))
     logging.info("HTTP status: %d", resp.status_code)
 
     if resp.status_code == requests.codes.ok:
         doc = xml.dom.minidom.parseString(resp.text)
         id = doc.getElementsByTagName('Id')
         if id:
-            result = True, key_data['domain'], selector, datetime.datetime.utcnow(), \
+            result = True, key_data['domain'], selector, datetime.datetime.now( datetime.timezone.utc ), \
                      get_text( id.item( 0 ).childNodes ), data
         else:
             logging.error("DNS API route53: cannot find ID in response")
@@ -143,7 +166,8 @@ def delete(dnsapi_data, dnsapi_domain_data, record_data, debugging = False):
 
     endpoint = "https://route53.amazonaws.com/2013-04-01/hostedzone/{0}/rrset".format(zone_id)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    resp = requests.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers)
+    resp = _session.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers,
+                         timeout = (5, 30))
     logging.info("HTTP status: %d", resp.status_code)
 
     if resp.status_code == requests.codes.ok:
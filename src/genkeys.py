@@ -18,14 +18,21 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
-import glob
 import importlib
 import logging
 import os
 import os.path
+import re
+import shutil
 import string
+import subprocess
 import sys
+import tempfile
+
+import requests
 
 # Settings, edit as appropriate for your environment
 
@@ -48,23 +55,36 @@ dns_update_data_filename = 'dns_update_data.ini'
 
 VERSION = '1.5.1'
 
-
-# Creates the private-key file, and the public-key txt-record file in chunked (BIND) form.
-# Returns a public key record dict, or None in the event of an error:
-#   selector: real selector value used if asked to avoid overwrites instead of failing
-#   plain:    unquoted unchunked data
-#   chunked:  BIND-format quoted chunked data
-def gen_key( target_name, selector, find_unused_selector = False ):
-    # Check for existence of resulting files and handle it
+# Matches one double-quoted chunk of a BIND-format TXT record value
+_CHUNK_RE = re.compile( r'"([^"]*)"' )
+
+# One parsed domains.ini record: domain name, key name, DNS API name and any
+# API-specific fields that follow
+Domain = collections.namedtuple( 'Domain', ['name', 'key_name', 'api', 'api_data'] )
+
+
+# Starts generation of one key. Checks for existing files, picks the selector
+# to actually use and launches opendkim-genkey without waiting for it, so the
+# driver can keep several generations in flight at once. The tool always
+# writes <selector>.private and <selector>.txt, so each run gets a private
+# scratch directory under the working directory to keep concurrent runs from
+# clobbering each other. Returns a job dict for finish_key_generation, or
+# None in the event of an error.
+def start_key_generation( target_name, selector, find_unused_selector = False ):
+    # Check for existence of resulting files and handle it. One directory scan
+    # replaces a pair of stat() calls per candidate suffix, which matters when
+    # hunting for an unused one.
     suffix_list = ['']
     if find_unused_selector:
         suffix_list += list( string.ascii_uppercase )
+    existing_names = { entry.name for entry in os.scandir( '.' )
+                       if entry.name.startswith( target_name + '.' ) }
     real_selector = None
     for suffix in suffix_list:
         rs = selector + suffix
         private_key_filename = target_name + "." + rs + ".key"
         public_key_filename = target_name + "." + rs + ".txt"
-        if (not os.path.exists( private_key_filename )) and (not os.path.exists( public_key_filename )):
+        if private_key_filename not in existing_names and public_key_filename not in existing_names:
             real_selector = rs
             break
     if real_selector is None:
@@ -74,100 +94,137 @@ def gen_key( target_name, selector, find_unused_selector = False ):
     if real_selector != selector:
         logging.warning( "Avoided overwriting keys for %s by using selector %s", target_name, real_selector )
 
-    # Use the OpenDKIM tool to generate the key data files
+    # Use the OpenDKIM tool to generate the key data files. An argument vector
+    # execs the tool directly instead of forking a shell to re-parse a command
+    # line.
+    scratch_dir = tempfile.mkdtemp( prefix = '.genkey-', dir = '.' )
     try:
-        wait_status = os.system( "opendkim-genkey -b 2048 -r -s " + selector + " -d " + target_name )
+        proc = subprocess.Popen( ['opendkim-genkey', '-b', '2048', '-r',
+                                  '-s', selector, '-d', target_name],
+                                 cwd = scratch_dir,
+                                 stdout = subprocess.DEVNULL, stderr = subprocess.PIPE )
     except OSError as e:
         logging.critical( "Error running opendkim-genkey" )
         logging.error( "%s", str( e ) )
+        shutil.rmtree( scratch_dir, ignore_errors = True )
         return None
-    status = (wait_status & 0xFF00) >> 8
-    if status != 0:
-        logging.critical( "Error status %d returned by opendkim-genkey", status )
-        return None
-
-    # The private key always ends up as target_name.selector.key
-    try:
-        os.rename( selector + ".private", private_key_filename )
-    except OSError as e:
-        logging.critical( "Cannot rename the private key file %s.private", selector )
-        logging.error( "%s", str( e ) )
-        return None
-
-    # Read opendkim-genkey's file and reformat the public key
-
-    # Snarf in the public key file for processing
+    return { 'target_name': target_name, 'selector': selector, 'real_selector': real_selector,
+             'private_key_filename': private_key_filename,
+             'public_key_filename': public_key_filename,
+             'scratch_dir': scratch_dir, 'proc': proc }
+
+
+# Reaps the opendkim-genkey process of a job, recording its exit status and
+# stderr output on the job dict. communicate() drains stderr while waiting, so
+# a chatty tool cannot fill the pipe buffer and deadlock a bare wait(). Safe
+# to call more than once; only the first call touches the process.
+def reap_keygen_proc( job ):
+    if 'status' not in job:
+        _, error_output = job['proc'].communicate()
+        job['status'] = job['proc'].returncode
+        job['error_output'] = error_output.decode( errors = 'replace' )
+
+
+# Waits for the opendkim-genkey process started by start_key_generation, then
+# moves the private-key file into place and creates the public-key txt-record
+# file in chunked (BIND) form. Returns a public key record dict, or None in
+# the event of an error:
+#   selector: real selector value used if asked to avoid overwrites instead of failing
+#   plain:    unquoted unchunked data
+#   chunked:  BIND-format quoted chunked data
+def finish_key_generation( job ):
+    selector = job['selector']
+    scratch_dir = job['scratch_dir']
     try:
-        pubkey_file = open( selector + ".txt", 'r' )
-    except IOError as e:
-        logging.critical( "Error accessing the public key file %s.txt", selector )
-        logging.error( "%s", str( e ) )
-        return None
-    input_text = pubkey_file.read()
-    pubkey_file.close()
-    if len( input_text ) <= 0:
-        logging.critical( "No input found" )
-        return None
+        reap_keygen_proc( job )
+        if job['status'] != 0:
+            logging.critical( "Error status %d returned by opendkim-genkey", job['status'] )
+            if len( job['error_output'] ) > 0:
+                logging.error( "%s", job['error_output'].strip() )
+            return None
+
+        # The private key always ends up as target_name.selector.key; replace()
+        # is atomic on every platform even with a stale file in the way
+        try:
+            os.replace( os.path.join( scratch_dir, selector + ".private" ),
+                        job['private_key_filename'] )
+        except OSError as e:
+            logging.critical( "Cannot rename the private key file %s.private", selector )
+            logging.error( "%s", str( e ) )
+            return None
 
-    # Find the first double-quote, and the double-quote after it. If we can't
-    # find the first one, we're either done (if we processed at least one chunk
-    # of data) or we have a syntax problem. If we can't find the second one, we
-    # definitely have a syntax problem. If we found both, extract the chunk of
-    # data between them and add it to the accumulated key data value (with or
-    # without the enclosing quotes and spacing depending on the format). Repeat
-    # until we can't find an opening double-quote.
-    value = ''
-    chunked_value = ''
-    start = 0
-    while start >= 0:
-        first_quote = input_text.find( '"', start )
-        if first_quote >= start:
-            second_quote = input_text.find( '"', first_quote + 1 )
-        else:
-            if len( value ) == 0:
-                # Error, we couldn't find the start
-                logging.critical( "Cannot find start of DNS record value" )
-                return None
-            else:
-                # We're done when we can't find the start of the next chunk
-                break
-        if second_quote >= 0:
-            # Unchunked form
-            value += input_text[first_quote + 1:second_quote]
-            # Chunked form
-            if len( chunked_value ) > 0:
-                chunked_value += ' '
-            chunked_value += input_text[first_quote:second_quote + 1]
-            start = second_quote + 1
-        else:
-            logging.error( "Syntax error in record data: no closing quote found" )
-            break
+        # Read opendkim-genkey's file and reformat the public key
 
-    # We should've found at least one chunk of key data
-    if len( value ) == 0:
-        logging.critical( "No DNS record value found" )
-        return None
+        # Snarf in the public key file for processing
+        try:
+            pubkey_file = open( os.path.join( scratch_dir, selector + ".txt" ), 'r' )
+        except IOError as e:
+            logging.critical( "Error accessing the public key file %s.txt", selector )
+            logging.error( "%s", str( e ) )
+            return None
+        input_text = pubkey_file.read()
+        pubkey_file.close()
+        if len( input_text ) <= 0:
+            logging.critical( "No input found" )
+            return None
+
+        # Pull out every double-quoted chunk of data in one pass, then join
+        # them into the unquoted unchunked form and the quoted chunked (BIND)
+        # form. An unterminated trailing quote is simply not matched, as with
+        # the old scan.
+        chunks = _CHUNK_RE.findall( input_text )
+
+        if len( chunks ) == 0:
+            logging.critical( "Cannot find start of DNS record value" )
+            return None
+        # Unchunked form
+        value = ''.join( chunks )
+        # Chunked form
+        chunked_value = ' '.join( '"%s"' % chunk for chunk in chunks )
+
+        # We should've found at least one chunk of key data
+        if len( value ) == 0:
+            logging.critical( "No DNS record value found" )
+            return None
+
+        # Write the reformatted record inside the scratch directory and move it
+        # into place atomically, so a crash can't leave a half-written public
+        # key file under the final name
+        tmp_filename = os.path.join( scratch_dir, selector + ".txt.tmp" )
+        with open( tmp_filename, 'w' ) as output_file:
+            output_file.write( chunked_value + '\n' )
+        os.replace( tmp_filename, job['public_key_filename'] )
+
+        return { 'selector': job['real_selector'], 'plain': value, 'chunked': chunked_value }
+    finally:
+        # Drops the scratch directory along with opendkim-genkey's originals,
+        # which we don't need anymore
+        shutil.rmtree( scratch_dir, ignore_errors = True )
 
-    output_file = open( public_key_filename, 'w' )
-    output_file.write( chunked_value + '\n' )
-    output_file.close()
 
-    # Clean up the file opendkim-genkey created, we don't need it anymore
-    try:
-        os.remove( selector + ".txt" )
-    except OSError as e:
-        logging.error( "Could not delete origin file %s.txt", selector )
-        logging.error( "%s", str( e ) )
+# Creates the private-key file, and the public-key txt-record file in chunked (BIND) form.
+# Returns a public key record dict, or None in the event of an error.
+def gen_key( target_name, selector, find_unused_selector = False ):
+    job = start_key_generation( target_name, selector, find_unused_selector )
+    if job is None:
         return None
-
-    return { 'selector': real_selector, 'plain': value, 'chunked': chunked_value }
+    return finish_key_generation( job )
 
 
 def process_ini_file( filename, critical = True ):
-    # Snarf in the contents
+    # Iterate the file directly rather than materializing every line up front;
+    # dns_update_data.ini accumulates history and can grow large. The with
+    # block also closes the file on error paths.
     try:
-        ini_file = open( filename, 'r' )
-        input_lines = ini_file.readlines()
+        with open( filename, 'r' ) as ini_file:
+            ini_data = []
+            for line in ini_file:
+                if line.lstrip().startswith( '#' ):
+                    continue
+                fields = line.split()
+                if len( fields ) > 0:
+                    ini_data.append( fields )
+            return ini_data
     except IOError as e:
         if critical:
             logging.critical( "Error accessing file %s", filename )
@@ -176,24 +233,14 @@ def process_ini_file( filename, critical = True ):
             logging.warning( "Error accessing file %s", filename )
             logging.warning( "%s", str( e ) )
         return None
-    ini_data = []
-    for line in input_lines:
-        fields = line.split()
-        if fields != None and len( fields ) > 0 and len( fields[0] ) > 0 and fields[0][0] != '#':
-            ini_data.append( fields )
-    return ini_data
 
 
 def fields_to_line( fields ):
-    line = ""
-    for field in fields:
-        if len( line ) > 0:
-            line += '\t'
-        if isinstance( field, datetime.datetime ):
-            line += field.strftime( '%Y-%m-%dT%H:%M:%S' )
-        else:
-            line += str( field )
-    return line
+    # isoformat() produces the same YYYY-MM-DDTHH:MM:SS form as the old
+    # strftime call without going through the format-string interpreter
+    return '\t'.join( field.isoformat( timespec = 'seconds' )
+                      if isinstance( field, datetime.datetime ) else str( field )
+                      for field in fields )
 
 
 def write_ini_file( filename, records ):
@@ -210,23 +257,20 @@ def write_ini_file( filename, records ):
     return
 
 
-def find_key_for_domain( domain_data, domain ):
-    for domain_entry in domain_data:
-        if domain_entry[0] == domain:
-            return domain_entry[1]
-    return None
+def find_key_for_domain( domain_to_key, domain ):
+    # domain_to_key is the precomputed domain-name-to-key-name dict, so the
+    # lookup is a single hash probe rather than a scan of domain_data.
+    return domain_to_key.get( domain )
 
 
 def find_dnsapi_modules( pn ):
     # Go through all possible names (pulled from what's mentioned in the
     # dnsapi.ini file) and for each one X see if we can load a module named
-    # dnsapi_X (file will be dnsapi_X.py).
+    # dnsapi_X (file will be dnsapi_X.py). The names are deduplicated so a
+    # repeated entry in dnsapi.ini only costs one import attempt, and null is
+    # always included.
     dnsapis = { }
-    possible_names = pn
-    # Make sure null is included
-    if 'null' not in possible_names:
-        possible_names.append( 'null' )
-    for api_name in possible_names:
+    for api_name in set( pn ) | { 'null' }:
         module_name = "dnsapi_" + api_name
         try:
             module = importlib.import_module( module_name )
@@ -338,25 +382,56 @@ domain_data = process_ini_file( domain_filename )
 if domain_data is None:
     logging.critical( "No domain definitions found in %s", domain_filename )
     sys.exit( 1 )
-# Make all domains with no API specified use the null API
-for item in domain_data:
-    if len( item ) < 3 or item[2] is None:
-        item[2] = 'null'
+# Parse the raw field lists into Domain records once, so the loops below use
+# attribute access instead of repeated slicing and length checks. Domains with
+# no API specified use the null API.
+domain_data = [Domain( fields[0], fields[1],
+                       fields[2] if len( fields ) > 2 and fields[2] is not None else 'null',
+                       fields[3:] )
+               for fields in domain_data]
 # We'll need a list of all the key names used by domains
 key_names = []
 for item in domain_data:
-    if item[1] not in key_names:
-        key_names.append( item[1] )
-
-# Generate our keys, one per key name
+    if item.key_name not in key_names:
+        key_names.append( item.key_name )
+# Map each domain name to its key name for constant-time lookups later
+domain_to_key = { item.name: item.key_name for item in domain_data }
+
+# Generate our keys, one per key name. Generating a 2048-bit RSA key is
+# CPU-bound in OpenSSL, so keep up to one opendkim-genkey process per core in
+# flight and collect the results afterwards.
 keys = { }  # Key = key name (field 1) from domain_data[n], Value = key data dict
+max_keygen_procs = os.cpu_count() or 1
+keygen_jobs = []
+running_jobs = []
 for target in key_names:
     logging.info( "Generating key %s", target )
-    key_data = gen_key( target, selector, avoid_collisions )
-    if key_data is None:
+    job = start_key_generation( target, selector, avoid_collisions )
+    if job is None:
         logging.critical( "    Error generating key %s", target )
+        for other_target, other_job in keygen_jobs:
+            reap_keygen_proc( other_job )
+            shutil.rmtree( other_job['scratch_dir'], ignore_errors = True )
         sys.exit( 1 )
+    keygen_jobs.append( (target, job) )
+    running_jobs.append( job )
+    if len( running_jobs ) >= max_keygen_procs:
+        reap_keygen_proc( running_jobs.pop( 0 ) )
+keygen_failed = False
+for target, job in keygen_jobs:
+    if keygen_failed:
+        # A previous key failed; just reap the process and drop its scratch files
+        reap_keygen_proc( job )
+        shutil.rmtree( job['scratch_dir'], ignore_errors = True )
+        continue
+    key_data = finish_key_generation( job )
+    if key_data is None:
+        logging.critical( "    Error generating key %s", target )
+        keygen_failed = True
+        continue
     keys[target] = key_data
+if keygen_failed:
+    sys.exit( 1 )
 # That also gives us the private key and public key txt files needed
 
 # Read contents of the existing key table file in case we need to leave existing
@@ -365,10 +440,19 @@ key_table_data = process_ini_file( "key.table", False )
 if key_table_data == None:
     key_table_data = []
 
+# Domains whose DNS update failed; their old table entries are preserved
+# below. A set, since it's mostly probed for membership.
+failed_domains = set()
+
 # Check for our DNS API modules. If we don't have any, there's no sense in
-# trying to do automatic updating even if we're supposed to.
+# trying to do automatic updating even if we're supposed to. Only APIs that
+# are both defined in dnsapi.ini and used by some domain this run are loaded;
+# importing the others would just pay their module (and requests) startup cost
+# for nothing. APIs a domain uses without a definition are reported per domain
+# later, as before.
 if should_update_dns:
-    dnsapis = find_dnsapi_modules( dnsapi_info.keys() )  # Key = DNS API name, Value = module
+    used_apis = { item.api for item in domain_data } & set( dnsapi_info.keys() )
+    dnsapis = find_dnsapi_modules( used_apis )  # Key = DNS API name, Value = module
     if len( dnsapis ) == 0:
         logging.warning( "No DNS API modules found at %s", os.path.dirname( __file__ ) )
         should_update_dns = False
@@ -377,10 +461,15 @@ if should_update_dns:
     update_data = process_ini_file( dns_update_data_filename, False )
 
     if update_data is not None:
-        # Convert update data timestamp field to a datetime
+        # Convert update data timestamp field to a datetime. fromisoformat is
+        # the C fast path; older files hold naive timestamps while the API
+        # modules now stamp records in UTC with an offset, so normalize aware
+        # values back to naive UTC to keep the cutoff comparison uniform.
         for record in update_data:
             if record[2] is not None:
-                dt = datetime.datetime.strptime( record[2], '%Y-%m-%dT%H:%M:%S' )
+                dt = datetime.datetime.fromisoformat( record[2] )
+                if dt.tzinfo is not None:
+                    dt = dt.astimezone( datetime.timezone.utc ).replace( tzinfo = None )
                 record[2] = dt
 
     logging.info( "Updating DNS records" )
@@ -389,143 +478,230 @@ if should_update_dns:
     # rotation is in use.
     cutoff_delta = datetime.timedelta( 70 )
     cutoff = datetime.datetime.now() - cutoff_delta
-    failed_domains = []
-    for item in domain_data:
-        if len( item ) > 2:
-            dnsapi_name = item[2]
-            dnsapi_domain_data = item[3:len( item )]
+
+    # Index expired records by domain so each worker only looks at its own
+    # domain's history.
+    old_records_by_domain = { }
+    if args.cleanup_files and update_data is not None:
+        for record in update_data:
+            if record[2] < cutoff:
+                old_records_by_domain.setdefault( record[0], [] ).append( record )
+
+    def process_deletes( item, dnsapi_module, dnsapi_name, dnsapi_data, dnsapi_domain_data,
+                         old_records ):
+        # Deletes the domain's expired records and returns the records the
+        # provider actually removed.
+        deleted_records = []
+        if len( old_records ) > 0:
+            logging.info( "Removing old records for %s", item.name )
+        for record in old_records:
             try:
-                if args.use_null_dnsapi:
-                    if dnsapi_name == 'fail':
-                        dnsapi_module = dnsapis[dnsapi_name]
+                result = dnsapi_module.delete( dnsapi_data, dnsapi_domain_data, record,
+                                               args.log_debug )
+            except requests.RequestException as e:
+                logging.error( "DNS API %s: request failed: %s", dnsapi_name, str( e ) )
+                result = False
+            if result is None:
+                logging.info( "No support for removing old record for %s:%s via %s API",
+                              record[0], record[1], dnsapi_name )
+                # Preserve record if we encountered an error
+            elif result:
+                logging.info( "Removing %s:%s created at %s", record[0], record[1],
+                              record[2].strftime( '%Y-%m-%d %H:%M:%S' ) )
+                deleted_records.append( record )
+            else:
+                logging.error( "Error removing old record for %s:%s via %s API",
+                               record[0], record[1], dnsapi_name )
+                # Preserve record if we encountered an error
+        return deleted_records
+
+    def process_delete_job( item, dnsapi_module, dnsapi_name, dnsapi_data, dnsapi_domain_data,
+                            key_data, old_records ):
+        # Runs in a worker thread: removes one domain's expired records. The
+        # deletes are independent of the adds (old records use old selectors),
+        # so they get their own futures and overlap with everything else.
+        return process_deletes( item, dnsapi_module, dnsapi_name, dnsapi_data,
+                                dnsapi_domain_data, old_records ), []
+
+    def process_add( item, dnsapi_module, dnsapi_name, dnsapi_data, dnsapi_domain_data,
+                     key_data, old_records ):
+        # Runs in a worker thread: adds one domain's record for the new selector
+        logging.info( "Updating selector %s for %s with key %s",
+                      key_data['selector'], item.name, item.key_name )
+        # A request that times out or exhausts its retries must fail the domain,
+        # not the whole run, so its table entries are preserved for a rerun
+        try:
+            add_result = dnsapi_module.add( dnsapi_data, dnsapi_domain_data, key_data,
+                                            args.log_debug )
+        except requests.RequestException as e:
+            logging.error( "DNS API %s: request failed: %s", dnsapi_name, str( e ) )
+            add_result = False,
+        return [], [(item, dnsapi_name, add_result)]
+
+    def process_batch_group( group ):
+        # Runs in a worker thread for modules that expose add_batch: every new
+        # record of the group goes to the provider in a single call.
+        for item, dnsapi_module, dnsapi_name, dnsapi_data, dnsapi_domain_data, key_data, \
+                old_records in group:
+            logging.info( "Updating selector %s for %s with key %s",
+                          key_data['selector'], item.name, item.key_name )
+        dnsapi_module = group[0][1]
+        dnsapi_name = group[0][2]
+        dnsapi_data = group[0][3]
+        try:
+            add_results = dnsapi_module.add_batch( dnsapi_data,
+                                                   [(job[4], job[5]) for job in group],
+                                                   args.log_debug )
+        except requests.RequestException as e:
+            logging.error( "DNS API %s: request failed: %s", dnsapi_name, str( e ) )
+            add_results = [(False,)] * len( group )
+        return [], [(job[0], dnsapi_name, add_result)
+                    for job, add_result in zip( group, add_results )]
+
+    # Resolve the module and configuration for each API name once, with the
+    # --use-null substitution already applied, so the per-domain loop below is
+    # a single dict lookup.
+    dnsapi_dispatch = { }
+    for name, module in dnsapis.items():
+        if args.use_null_dnsapi and name != 'fail':
+            module = dnsapis['null']
+        dnsapi_dispatch[name] = (module, dnsapi_info.get( name, [] ))
+
+    # Resolve each domain's module and key data up front, then hand the network
+    # calls to a thread pool so the per-domain round-trips overlap instead of
+    # being paid one RTT after another. The sessions the API modules keep are
+    # thread-safe, so workers share the pooled connections.
+    jobs = []
+    for item in domain_data:
+        dnsapi_module, dnsapi_data = dnsapi_dispatch.get( item.api, (None, None) )
+        key_data = keys.get( item.key_name )
+        if dnsapi_module is None:
+            logging.error( "No DNS API %s found for %s", item.api, item.name )
+        if dnsapi_module is not None and dnsapi_data is not None and key_data is not None:
+            # One dict construction instead of a copy plus two mutations; the
+            # shared entry in keys stays untouched
+            key_data = { **key_data, 'domain': item.name, 'dnsapi': item.api }
+            jobs.append( (item, dnsapi_module, item.api, dnsapi_data,
+                          item.api_data, key_data,
+                          old_records_by_domain.get( item.name, [] )) )
+
+    # Jobs whose module can add several records in one request are grouped by
+    # API name; the rest are dispatched one domain per worker.
+    batch_groups = { }
+    single_jobs = []
+    for job in jobs:
+        if hasattr( job[1], 'add_batch' ):
+            batch_groups.setdefault( job[2], [] ).append( job )
+        else:
+            single_jobs.append( job )
+
+    # Every domain with expired records also contributes a delete job, so the
+    # deletes overlap with each other and with the adds instead of running
+    # ahead of each domain's add in the same worker.
+    delete_jobs = [job for job in jobs if len( job[6] ) > 0]
+
+    deleted_ids = set()
+    if len( single_jobs ) > 0 or len( batch_groups ) > 0 or len( delete_jobs ) > 0:
+        worker_count = min( 16, len( single_jobs ) + len( batch_groups ) + len( delete_jobs ) )
+        with concurrent.futures.ThreadPoolExecutor( max_workers = worker_count ) as executor:
+            futures = [executor.submit( process_delete_job, *job ) for job in delete_jobs]
+            futures += [executor.submit( process_add, *job ) for job in single_jobs]
+            futures += [executor.submit( process_batch_group, group )
+                        for group in batch_groups.values()]
+            for future in concurrent.futures.as_completed( futures ):
+                deleted_records, outcomes = future.result()
+                for record in deleted_records:
+                    deleted_ids.add( id( record ) )
+                for item, dnsapi_name, add_result in outcomes:
+                    if add_result[0]:
+                        logging.info( "Update succeeded." )
+                        records = list( add_result[1:] )
+                        if update_data is None:
+                            update_data = []
+                        update_data.append( records )
                     else:
-                        dnsapi_module = dnsapis['null']
-                else:
-                    dnsapi_module = dnsapis[dnsapi_name]
-                dnsapi_data = dnsapi_info[dnsapi_name]
-                key_data = keys[item[1]].copy()
-            except KeyError:
-                dnsapi_module = None
-                dnsapi_data = None
-                key_data = None
-            if dnsapi_module is None:
-                logging.error( "No DNS API %s found for %s", dnsapi_name, item[0] )
-            if dnsapi_module is not None and dnsapi_data is not None and key_data is not None:
-                key_data['domain'] = item[0]
-                key_data['dnsapi'] = dnsapi_name
-                if args.cleanup_files and update_data is not None:
-                    # Clean up old records
-                    removed_count = 0
-                    new_update_data = []
-                    for record in update_data:
-                        if record[0] == item[0] and record[2] < cutoff:
-                            if removed_count == 0:
-                                logging.info( "Removing old records for %s", item[0] )
-                            removed_count += 1
-                            result = dnsapi_module.delete( dnsapi_data, dnsapi_domain_data, record, args.log_debug )
-                            if result is None:
-                                logging.info( "No support for removing old record for %s:%s via %s API",
-                                              record[0], record[1], dnsapi_name )
-                                # Preserve record if we encountered an error
-                                new_update_data.append( record )
-                            elif result:
-                                logging.info( "Removing %s:%s created at %s", record[0], record[1],
-                                              record[2].strftime( '%Y-%m-%d %H:%M:%S' ) )
-                            else:
-                                logging.error( "Error removing old record for %s:%s via %s API",
-                                               record[0], record[1], dnsapi_name )
-                                # Preserve record if we encountered an error
-                                new_update_data.append( record )
-                        else:
-                            new_update_data.append( record )
-                    update_data = new_update_data
-                # Add new record
-                logging.info( "Updating selector %s for %s with key %s", key_data['selector'], item[0], item[1] )
-                result = dnsapi_module.add( dnsapi_data, dnsapi_domain_data, key_data, args.log_debug )
-                if result[0]:
-                    logging.info( "Update succeeded." )
-                    records = list( result[1:] )
-                    if update_data is None:
-                        update_data = []
-                    update_data.append( records )
-                else:
-                    logging.error( "Error adding new record for %s with key %s via %s API",
-                                   item[0], item[1], dnsapi_name )
-                    failed_domains.append( item[0] )
+                        logging.error( "Error adding new record for %s with key %s via %s API",
+                                       item.name, item.key_name, dnsapi_name )
+                        failed_domains.add( item.name )
+    if len( deleted_ids ) > 0:
+        update_data = [record for record in update_data if id( record ) not in deleted_ids]
 
     if update_data is not None:
         write_ini_file( dns_update_data_filename, update_data )
 
         if args.cleanup_files:
-            target_list = []
-            # Find all files that match the name pattern for one of our domain name abbreviations
-            for target in key_names:
-                target_list += glob.glob( target + '.*.key' ) + glob.glob( target + '.*.txt' )
-            # Go through the update data and remove the entries from target_list that're still referred
-            # to by an update_data item.
+            # Find all files that match the name pattern for one of our domain
+            # name abbreviations. One directory scan covers every abbreviation
+            # and both extensions instead of two glob passes per abbreviation.
+            # Names look like <key name>.<selector>.<extension>; key names may
+            # contain dots but selectors never do, so split from the right.
+            key_name_set = set( key_names )
+            target_set = set()
+            with os.scandir( '.' ) as dir_entries:
+                for entry in dir_entries:
+                    name = entry.name
+                    if not name.endswith( ('.key', '.txt') ):
+                        continue
+                    fields = name.rsplit( '.', 2 )
+                    if len( fields ) == 3 and fields[0] in key_name_set:
+                        target_set.add( name )
+            # Go through the update data and remove the entries from target_set that're still referred
+            # to by an update_data item. Each probe is a hash lookup rather than a list scan.
             for item in update_data:
                 if len( item ) < 2:
                     continue
-                domain_key = find_key_for_domain( domain_data, item[0] )
+                domain_key = find_key_for_domain( domain_to_key, item[0] )
                 if domain_key is not None:
-                    for suffix in ['.key', '.txt']:
-                        item_str = domain_key + '.' + item[1] + suffix
-                        try:
-                            i = target_list.index( item_str )
-                        except:
-                            i = -1
-                        if i >= 0:
-                            del target_list[i]
+                    target_set.discard( domain_key + '.' + item[1] + '.key' )
+                    target_set.discard( domain_key + '.' + item[1] + '.txt' )
             # Don't clean entries for domains that failed the DNS update
-            for item in failed_domains:
-                domain_key = find_key_for_domain( domain_data, item )
-                if domain_key is not None:
-                    new_list = [x for x in target_list if not x.startswith( domain_key + '.' )]
-                    target_list = new_list
-            # What's left in target_list are just the files that aren't referred to anymore and are
+            failed_prefixes = tuple( domain_to_key[item] + '.' for item in failed_domains
+                                     if item in domain_to_key )
+            if len( failed_prefixes ) > 0:
+                target_set = { x for x in target_set if not x.startswith( failed_prefixes ) }
+            # What's left in target_set are just the files that aren't referred to anymore and are
             # eligible for being deleted.
-            for filename in target_list:
+            for filename in target_set:
                 logging.info( "Removing obsolete file %s", filename )
                 try:
                     os.remove( filename )
                 except:
                     logging.warning( "Failed removing obsolete file %s", filename )
 
-# Generate the key.table and signing.table files
+    # Let API modules release their pooled connections now that we're done with them
+    for dnsapi_module in dnsapis.values():
+        if hasattr( dnsapi_module, 'close' ):
+            dnsapi_module.close()
+
+# Generate the key.table and signing.table files. The lines are accumulated
+# in memory and handed to the OS in one writelines() call per file instead of
+# one small write per record.
 logging.info( "Generating key and signing tables" )
-try:
-    key_table_file = open( "key.table", 'w' )
-    signing_table_file = open( "signing.table", 'w' )
-except IOError as e:
-    logging.critical( "Error creating new key or signing table file" )
-    logging.error( "%s", str( e ) )
-    sys.exit( 1 )
-# Write the unupdated entries back to the files
+key_lines = []
+signing_lines = []
+# Keep the unupdated entries for the files
 for key_item in key_table_data:
     key_domain = key_item[1].split( ':' )[0]
     if key_domain in failed_domains:
         logging.info( "Preserving entries for %s", key_domain )
-        try:
-            key_table_file.write( "%s\n" % (fields_to_line( key_item )) )
-            signing_table_file.write( "*@%s\t%s\n" % (key_domain, key_item[0]) )
-        except IOError as e:
-            logging.critical( "Error writing new key or signing table file" )
-            logging.error( "%s", str( e ) )
-            sys.exit( 1 )
-# Now write the updated lines to the files
+        key_lines.append( f"{fields_to_line( key_item )}\n" )
+        signing_lines.append( f"*@{key_domain}\t{key_item[0]}\n" )
+# Now add the updated lines
 for item in domain_data:
-    if item[0] not in failed_domains:
-        code = item[0].replace( '.', '-' )
-        logging.info( "Adding entries for %s", item[0] )
-        try:
-            key_table_file.write( "%s\t%s:%s:%s/%s.%s.key\n" % \
-                                  (code, item[0], selector, opendkim_dir, item[1], selector) )
-            signing_table_file.write( "*@%s\t%s\n" % (item[0], code) )
-        except IOError as e:
-            logging.critical( "Error writing new key or signing table file" )
-            logging.error( "%s", str( e ) )
-            sys.exit( 1 )
-key_table_file.close()
-signing_table_file.close()
+    if item.name not in failed_domains:
+        code = item.name.replace( '.', '-' )
+        logging.info( "Adding entries for %s", item.name )
+        key_lines.append( f"{code}\t{item.name}:{selector}:"
+                          f"{opendkim_dir}/{item.key_name}.{selector}.key\n" )
+        signing_lines.append( f"*@{item.name}\t{code}\n" )
+try:
+    with open( "key.table", 'w' ) as key_table_file:
+        key_table_file.writelines( key_lines )
+    with open( "signing.table", 'w' ) as signing_table_file:
+        signing_table_file.writelines( signing_lines )
+except IOError as e:
+    logging.critical( "Error writing new key or signing table file" )
+    logging.error( "%s", str( e ) )
+    sys.exit( 1 )
 
 sys.exit( 0 )